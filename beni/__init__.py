@@ -7,21 +7,31 @@ Generate environment.yml from pyproject.toml
 from __future__ import annotations
 
 import argparse
-import json
+import functools
+import os
+import pickle
+import tempfile
+import threading
 import typing
 import urllib.request
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from copy import copy
 from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
 from enum import Enum, auto
+from http import HTTPStatus
+from http.client import IncompleteRead
 from pathlib import Path
 from shutil import copyfileobj
+from urllib.error import HTTPError
 from urllib.parse import urlparse
 
 import platformdirs
 import tqdm
-import typeguard
 import yaml
 from packaging.requirements import Requirement
+from packaging.utils import canonicalize_name
 
 try:
     import flit_core.config as flit_config
@@ -32,6 +42,37 @@ except ImportError:
 
     flit2 = True
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader  # type: ignore
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
+try:
+    import ijson
+
+    # The pure Python backends are much slower than parsing the whole file at once
+    if ijson.backend not in {"yajl2_c", "yajl2_cffi"}:
+        ijson = None
+except ImportError:
+    ijson = None  # type: ignore
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib  # type: ignore
+    except ImportError:
+        try:
+            from flit_core.vendor import tomli as tomllib  # type: ignore
+        except ImportError:
+            tomllib = None  # type: ignore
+
 
 __version__ = "0.4.4"
 
@@ -110,30 +151,85 @@ parser.add_argument(
 )
 
 
+@contextmanager
+def replace_atomically(path: Path) -> typing.Iterator[typing.BinaryIO]:
+    """Open a temporary file that replaces `path` once it has been written"""
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+_cache_locks: typing.Dict[str, threading.Lock] = {}
+
+
 def get_cached(url: str, max_age: timedelta = timedelta(hours=1)) -> Path:
+    # Concurrent calls for one URL wait for a running download instead of repeating it
+    with _cache_locks.setdefault(url, threading.Lock()):
+        return _get_cached(url, max_age)
+
+
+def _get_cached(url: str, max_age: timedelta) -> Path:
     parts = urlparse(url)
     cache_path = CACHE_DIR / parts.netloc / parts.path.lstrip("/")
+    # Holds the ETag, and gets touched whenever the server says the cache is current
+    etag_path = cache_path.with_name(f"{cache_path.name}.etag")
+    headers = {"User-Agent": "beni"}
     if cache_path.is_file():
-        last_modified = datetime.fromtimestamp(cache_path.stat().st_mtime, timezone.utc)
+        last_checked = max(
+            p.stat().st_mtime for p in (cache_path, etag_path) if p.is_file()
+        )
+        last_modified = datetime.fromtimestamp(last_checked, timezone.utc)
         now = datetime.now(timezone.utc)
         if (now - last_modified) < max_age:
             return cache_path
+        headers["If-Modified-Since"] = formatdate(
+            cache_path.stat().st_mtime, usegmt=True
+        )
+        if etag_path.is_file() and (etag := etag_path.read_text()):
+            headers["If-None-Match"] = etag
         msg = f"Re-creating old cache for {cache_path.name}"
     else:
         cache_path.parent.mkdir(exist_ok=True, parents=True)
         msg = f"Creating cache for {cache_path.name} at {CACHE_DIR}"
 
-    req = urllib.request.Request(url, headers={"User-Agent": "beni"})
-    with urllib.request.urlopen(req) as resp, tqdm.tqdm.wrapattr(
-        cache_path.open("wb"), "write", desc=msg, total=getattr(resp, "length", None)
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req)
+    except HTTPError as e:
+        with e:
+            if e.code != HTTPStatus.NOT_MODIFIED:
+                raise
+            etag_path.touch()
+            return cache_path
+    # Download to a temporary file, so an interrupted download leaves no truncated cache
+    with resp, replace_atomically(cache_path) as cache_file, tqdm.tqdm.wrapattr(
+        cache_file, "write", desc=msg, total=getattr(resp, "length", None)
     ) as f:
         copyfileobj(resp, f)
+        # Chunked reads don’t raise if the connection drops early
+        if getattr(resp, "length", None):
+            raise IncompleteRead(b"", resp.length)
+    if etag := resp.headers.get("ETag"):
+        etag_path.write_text(etag)
+    else:
+        etag_path.unlink(missing_ok=True)
     return cache_path
 
 
+def prefetch_cached(url: str) -> None:
+    # Errors are raised again once the file is actually requested
+    with suppress(Exception):
+        get_cached(url)
+
+
 class CondaForgeMapper:
-    data: typing.List[CFMapping]
-    """All non-trivial mappings between PyPI and Conda Forge packages"""
+    _CACHE_FORMAT = 2
+    """Version of the pickled data, to be bumped when `_parse`’s output changes"""
 
     cf_pkgs: typing.Set[str]
     """All Conda Forge package names"""
@@ -142,17 +238,48 @@ class CondaForgeMapper:
     """A dict from normalized PyPI name to conda forge name"""
 
     def __init__(self):
-        self.data = typing.cast(
-            typing.List[CFMapping],
-            yaml.safe_load(get_cached(CF_MAPPING_URL).read_bytes()),
+        # Both files are independent, so download them concurrently
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            mapping_path, graph_path = pool.map(
+                get_cached, [CF_MAPPING_URL, CF_GRAPH_URL]
+            )
+        # Parsing dominates, so reuse the parsed data while the downloads are unchanged
+        key = "-".join(str(p.stat().st_mtime_ns) for p in (mapping_path, graph_path))
+        derived_path = (
+            CACHE_DIR / "derived" / f"mapper-v{self._CACHE_FORMAT}-{key}.pickle"
         )
-        self.cf_pkgs = {
-            self._normalize(n["id"])
-            for n in json.loads(get_cached(CF_GRAPH_URL).read_bytes())["nodes"]
-        }
-        self._pypi2cf = {
-            self._normalize(m["pypi_name"]): m["conda_name"] for m in self.data
-        }
+        try:
+            with derived_path.open("rb") as f:
+                self.cf_pkgs, self._pypi2cf = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            self._parse(mapping_path, graph_path)
+            derived_path.parent.mkdir(exist_ok=True, parents=True)
+            for stale_path in derived_path.parent.glob("mapper-*.pickle"):
+                stale_path.unlink(missing_ok=True)
+            # Write atomically, so concurrent runs never load a partial pickle
+            with replace_atomically(derived_path) as f:
+                pickle.dump(
+                    (self.cf_pkgs, self._pypi2cf),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+
+    def _parse(self, mapping_path: Path, graph_path: Path) -> None:
+        # All non-trivial mappings between PyPI and Conda Forge packages
+        with mapping_path.open("rb") as f:
+            data = typing.cast(typing.List[CFMapping], yaml.load(f, Loader=SafeLoader))
+        self._pypi2cf = {self._normalize(m["pypi_name"]): m["conda_name"] for m in data}
+        self.cf_pkgs = {self._normalize(n) for n in self._iter_node_ids(graph_path)}
+
+    @staticmethod
+    def _iter_node_ids(graph_path: Path) -> typing.Iterator[str]:
+        """Iterate over the package names in graph.json, streaming it if possible"""
+        if ijson is None:
+            for n in json_loads(graph_path.read_bytes())["nodes"]:
+                yield n["id"]
+            return
+        with graph_path.open("rb") as f:
+            yield from ijson.items(f, "nodes.item.id")
 
     @staticmethod
     def _normalize(name: str) -> str:
@@ -167,23 +294,30 @@ class CondaForgeMapper:
         )
 
 
+@functools.lru_cache(maxsize=1)
+def get_mapper() -> CondaForgeMapper:
+    """Get the shared CondaForgeMapper, constructing it on first use."""
+    return CondaForgeMapper()
+
+
 class Environment(typing.TypedDict):
     name: str
     channels: typing.List[str]
     dependencies: typing.List[typing.Union[str, typing.Dict[str, typing.List[str]]]]
 
 
-@typeguard.typechecked
 def generate_environment(
     name: str,
     python_version: typing.Optional[str],
     requirements: typing.List[Requirement],
+    mapper: typing.Optional[CondaForgeMapper] = None,
 ) -> Environment:
     # Using dicts to preserve order
     deps_conda = dict.fromkeys([f"python{python_version or ''}", "pip"])
     deps_pip = dict.fromkeys(["flit"])
 
-    mapper = CondaForgeMapper()
+    if mapper is None:
+        mapper = get_mapper()
     for r in requirements:
         if cf_name := mapper.pypi2cf(r.name):
             deps_conda[f"{cf_name}{r.specifier}"] = None
@@ -197,8 +331,58 @@ def generate_environment(
     }
 
 
+class MinimalConfig(typing.NamedTuple):
+    """The parts of flit’s LoadedConfig that beni uses"""
+
+    module: str
+    metadata: typing.Dict[str, typing.Any]
+    reqs_by_extra: typing.Dict[str, typing.List[str]]
+
+
+Config = typing.Union[flit_config.LoadedConfig, MinimalConfig]
+
+
+def read_config(path: Path) -> Config:
+    """Read a config, skipping flit’s full validation for PEP 621 metadata"""
+    if tomllib is not None and path.suffix == ".toml":
+        with path.open("rb") as f:
+            d = tomllib.load(f)
+        if "project" in d:
+            return read_pep621_config(d)
+    return flit_config.read_flit_config(str(path) if flit2 else path)
+
+
+def read_pep621_config(d: typing.Dict[str, typing.Any]) -> MinimalConfig:
+    proj = d["project"]
+    module_tbl = d.get("tool", {}).get("flit", {}).get("module", {})
+    reqs_by_extra: typing.Dict[str, typing.List[str]] = {
+        canonicalize_name(extra): reqs
+        for extra, reqs in proj.get("optional-dependencies", {}).items()
+    }
+    # Same format as flit uses for requires_dist
+    requires_dist = list(proj.get("dependencies", []))
+    for extra, reqs in sorted(reqs_by_extra.items()):
+        for req in reqs:
+            if ";" in req:
+                name, envmark = req.split(";", 1)
+                requires_dist.append(f'{name} ; extra == "{extra}" and ({envmark})')
+            else:
+                requires_dist.append(f'{req} ; extra == "{extra}"')
+    # Like flit, record the main requirements as a '.none' extra
+    if proj.get("dependencies"):
+        reqs_by_extra[".none"] = proj["dependencies"]
+    metadata: typing.Dict[str, typing.Any] = dict(requires_dist=requires_dist)
+    if "requires-python" in proj:
+        metadata["requires_python"] = proj["requires-python"]
+    return MinimalConfig(
+        module=module_tbl.get("name", proj["name"].replace("-", "_")),
+        metadata=metadata,
+        reqs_by_extra=reqs_by_extra,
+    )
+
+
 def extras_to_install(
-    c: flit_config.LoadedConfig, deps: Deps, extras: typing.Sequence[str]
+    c: Config, deps: Deps, extras: typing.Sequence[str]
 ) -> typing.Set[str]:
     to_install = set(extras)
     if any(
@@ -214,18 +398,27 @@ def extras_to_install(
     return to_install
 
 
-def is_in_extras(req: Requirement, extras: typing.Set[str]):
+def is_in_extras(
+    req: Requirement, environments: typing.Sequence[typing.Dict[str, str]]
+) -> bool:
+    """Check if a requirement is needed, given one marker environment per extra"""
     if not req.marker:
         return True
-    for extra in extras:
-        if req.marker.evaluate(dict(extra=extra)):
-            return True
-    return False
+    return any(req.marker.evaluate(env) for env in environments)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_requirement(req: str) -> Requirement:
+    """Parse a PEP 508 requirement. Results are shared, so don’t mutate them."""
+    return Requirement(req)
 
 
 def clear_extras(reqs: typing.Iterable[Requirement]):
-    reqs_no_extra = [deepcopy(r) for r in reqs]
-    for r in reqs_no_extra:
+    reqs_no_extra = []
+    for r in reqs:
+        # Shallow copies suffice, as markers are only replaced, never mutated
+        r = copy(r)
+        reqs_no_extra.append(r)
         if r.marker is None:
             continue
         markers = getattr(r.marker, "_markers", [])
@@ -241,38 +434,56 @@ def clear_extras(reqs: typing.Iterable[Requirement]):
             r.marker = None
         elif markers[0][0].value == "extra" and markers[1] == "and":
             # Extra at the start
-            r.marker._markers[:2] = []
+            r.marker = copy(r.marker)
+            r.marker._markers = markers[2:]
         elif markers[-2] == "and" and markers[-1][0].value == "extra":
             # Extra at the end
-            r.marker._markers[-2:] = []
+            r.marker = copy(r.marker)
+            r.marker._markers = markers[:-2]
     return reqs_no_extra
 
 
 def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
     args = parser.parse_args(argv)
+    for path in args.paths:
+        if not path.is_file():
+            parser.error(f"{path} is not a file")
+    if args.format is Format.conda:
+        # Download the conda-forge data in the background while the configs are read.
+        # Daemon threads, so errors in the configs don’t wait for the downloads.
+        for url in [CF_MAPPING_URL, CF_GRAPH_URL]:
+            threading.Thread(target=prefetch_cached, args=(url,), daemon=True).start()
     python_version: typing.Optional[str] = None
     requires: typing.List[Requirement] = []
     first_module: typing.Optional[str] = None
     ignored_modules: typing.List[str] = args.ignore or []
-    for path in args.paths:
-        c = flit_config.read_flit_config(str(path) if flit2 else path)
+    # Configs are independent, so read them concurrently (results keep path order)
+    with ThreadPoolExecutor(max_workers=min(8, len(args.paths))) as pool:
+        configs = list(pool.map(read_config, args.paths))
+    for c in configs:
         if not first_module:
             first_module = c.module
         ignored_modules.append(c.module)
         metadata = c.metadata
-        extras = extras_to_install(c, args.deps, args.extras)
+        environments = [
+            dict(extra=extra) for extra in extras_to_install(c, args.deps, args.extras)
+        ]
         if "requires_python" in metadata:
             python_version = metadata["requires_python"]
         if "requires_dist" in metadata:
-            reqs = map(Requirement, metadata["requires_dist"])
-            reqs_filtered = filter(lambda req: is_in_extras(req, extras), reqs)
-            requires.extend(reqs_filtered)
+            reqs = map(parse_requirement, metadata["requires_dist"])
+            if environments:
+                requires.extend(r for r in reqs if is_in_extras(r, environments))
+            else:
+                # Without extras, is_in_extras is only true for markerless requirements
+                requires.extend(r for r in reqs if not r.marker)
     assert first_module is not None
 
-    reqs_final = [r for r in requires if r.name not in ignored_modules]
+    ignored = {canonicalize_name(m) for m in ignored_modules}
+    reqs_final = [r for r in requires if canonicalize_name(r.name) not in ignored]
     if args.format is Format.conda:
         env = generate_environment(first_module, python_version, reqs_final)
-        spec = yaml.dump(env)
+        spec = yaml.dump(env, Dumper=SafeDumper)
     elif args.format is Format.pip:
         spec = "\n".join(map(str, clear_extras(reqs_final)))
     else:
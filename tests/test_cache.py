@@ -0,0 +1,88 @@
+import os
+import threading
+import typing
+from datetime import timedelta
+from http import HTTPStatus
+from http.client import IncompleteRead
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+import beni
+
+
+class Handler(BaseHTTPRequestHandler):
+    body = b"v1"
+    truncate = False
+    requests: typing.List[typing.Dict[str, str]] = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        etag = f'"{self.body.decode()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(self.body) + self.truncate))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url(tmp_path: Path, monkeypatch: MonkeyPatch) -> typing.Iterator[str]:
+    monkeypatch.setattr(beni, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(Handler, "requests", [])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/data.json"
+    server.shutdown()
+    server.server_close()
+
+
+def age(path: Path, seconds: float = 7200):
+    mtime = path.stat().st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_revalidate(url: str, monkeypatch: MonkeyPatch):
+    path = beni.get_cached(url)
+    etag_path = path.with_name("data.json.etag")
+    assert path.read_bytes() == b"v1"
+    assert etag_path.read_text() == '"v1"'
+
+    # Fresh: no request
+    beni.get_cached(url)
+    assert len(Handler.requests) == 1
+
+    # Stale but unchanged: 304 keeps the file and touches the sidecar
+    age(path)
+    age(etag_path)
+    mtime = path.stat().st_mtime
+    assert beni.get_cached(url) == path
+    assert Handler.requests[-1]["If-None-Match"] == '"v1"'
+    assert "If-Modified-Since" in Handler.requests[-1]
+    assert path.stat().st_mtime == mtime
+    assert path.read_bytes() == b"v1"
+    beni.get_cached(url)
+    assert len(Handler.requests) == 2
+
+    # Stale and changed: download again and store the new ETag
+    monkeypatch.setattr(Handler, "body", b"v2")
+    beni.get_cached(url, max_age=timedelta(0))
+    assert path.read_bytes() == b"v2"
+    assert etag_path.read_text() == '"v2"'
+
+
+def test_interrupted_download(url: str, monkeypatch: MonkeyPatch, tmp_path: Path):
+    monkeypatch.setattr(Handler, "truncate", True)
+    with pytest.raises(IncompleteRead):
+        beni.get_cached(url)
+    assert [p.name for p in tmp_path.rglob("*") if p.is_file()] == []
@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import pytest
+from _pytest.capture import CaptureFixture
+
+import beni
+from beni import main, read_config
+
+PYPROJECT = """\
+[project]
+name = "my-pkg"
+version = "1.0"
+description = "A package"
+requires-python = ">=3.8"
+dependencies = ["pyyaml", "tomli; python_version < '3.11'"]
+
+[project.optional-dependencies]
+test = ["pytest"]
+Dev_Tools = ["pre-commit", "pywin32; sys_platform == 'win32'"]
+"""
+
+PYPROJECT_NO_EXTRAS = """\
+[project]
+name = "my-pkg"
+version = "1.0"
+description = "A package"
+dependencies = ["foo; python_version >= '3'", "bar"]
+"""
+
+needs_tomllib = pytest.mark.skipif(
+    beni.tomllib is None, reason="lean reader needs tomllib or tomli"
+)
+
+
+@needs_tomllib
+@pytest.mark.skipif(
+    not hasattr(beni.flit_config, "read_pep621_metadata"),
+    reason="flit_core too old for [project] metadata",
+)
+@pytest.mark.parametrize(
+    "pyproject",
+    [
+        PYPROJECT,
+        PYPROJECT + '[tool.flit.module]\nname = "my_mod"\n',
+        PYPROJECT_NO_EXTRAS,
+    ],
+    ids=["extras", "module", "no-extras"],
+)
+def test_pep621_like_flit(tmp_path: Path, pyproject: str):
+    path = tmp_path / "pyproject.toml"
+    path.write_text(pyproject)
+    c = read_config(path)
+    expected = beni.flit_config.read_flit_config(path)
+    assert c.module == expected.module
+    for key in ["requires_python", "requires_dist"]:
+        assert c.metadata.get(key) == expected.metadata.get(key)
+    assert c.reqs_by_extra == expected.reqs_by_extra
+
+
+@needs_tomllib
+def test_pep621_marker_deps_without_extras(tmp_path: Path, capsys: CaptureFixture):
+    path = tmp_path / "pyproject.toml"
+    path.write_text(PYPROJECT_NO_EXTRAS)
+    main([str(path), "--format=pip"])
+    assert capsys.readouterr().out.split() == ["foo", "bar"]
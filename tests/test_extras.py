@@ -0,0 +1,32 @@
+from packaging.requirements import Requirement
+
+from beni import clear_extras, is_in_extras
+
+
+def test_clear_extras():
+    reqs = [
+        Requirement('pytest; extra == "test"'),
+        Requirement('pywin32; extra == "dev" and sys_platform == "win32"'),
+        Requirement('tomli; python_version < "3.11" and extra == "dev"'),
+        Requirement("tqdm"),
+    ]
+    cleared = clear_extras(reqs)
+    assert list(map(str, cleared)) == [
+        "pytest",
+        'pywin32; sys_platform == "win32"',
+        'tomli; python_version < "3.11"',
+        "tqdm",
+    ]
+
+
+def test_clear_extras_keeps_originals():
+    req = Requirement('pywin32; extra == "dev" and sys_platform == "win32"')
+    clear_extras([req])
+    assert str(req) == 'pywin32; extra == "dev" and sys_platform == "win32"'
+
+
+def test_is_in_extras():
+    environments = [dict(extra="dev"), dict(extra="test")]
+    assert is_in_extras(Requirement("tqdm"), environments)
+    assert is_in_extras(Requirement('pytest; extra == "test"'), environments)
+    assert not is_in_extras(Requirement('sphinx; extra == "doc"'), environments)
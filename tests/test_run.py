@@ -4,11 +4,11 @@ from pathlib import Path
 import yaml
 from _pytest.capture import CaptureFixture
 
-from beni import main
+from beni import SafeLoader, main
 
 proj_dir = Path(__file__).parent.parent
 pyproj_path = proj_dir / "pyproject.toml"
-environment = yaml.safe_load((proj_dir / "environment.yml").read_text())
+environment = yaml.load((proj_dir / "environment.yml").read_text(), Loader=SafeLoader)
 
 dev_deps = ["pre-commit", "ipython"]
 test_deps = ["pytest"]
@@ -17,7 +17,7 @@ test_deps = ["pytest"]
 def test_run_basic(capsys: CaptureFixture):
     expected = deepcopy(environment)
     main([str(pyproj_path)])
-    actual = yaml.safe_load(capsys.readouterr().out)
+    actual = yaml.load(capsys.readouterr().out, Loader=SafeLoader)
     assert expected == actual
 
 
@@ -27,7 +27,7 @@ def test_run_prod_deps(capsys: CaptureFixture):
         assert dep in expected["dependencies"]
         expected["dependencies"].remove(dep)
     main([str(pyproj_path), "--deps=production"])
-    actual = yaml.safe_load(capsys.readouterr().out)
+    actual = yaml.load(capsys.readouterr().out, Loader=SafeLoader)
     assert expected == actual
 
 
@@ -36,5 +36,14 @@ def test_run_dev_extra(capsys: CaptureFixture):
     for dep in test_deps:
         expected["dependencies"].remove(dep)
     main([str(pyproj_path), "--extras=dev"])
-    actual = yaml.safe_load(capsys.readouterr().out)
+    actual = yaml.load(capsys.readouterr().out, Loader=SafeLoader)
+    assert expected == actual
+
+
+def test_run_ignore(capsys: CaptureFixture):
+    expected = deepcopy(environment)
+    expected["dependencies"].remove("pyyaml")
+    expected["dependencies"].remove("flit-core<4,>=2")
+    main([str(pyproj_path), "--ignore", "PyYAML", "flit_core"])
+    actual = yaml.load(capsys.readouterr().out, Loader=SafeLoader)
     assert expected == actual